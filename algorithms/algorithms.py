@@ -1,5 +1,13 @@
+import copy
+import os
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
 import xarray as xr
 import numpy as np
+import numba
 # importing the TDigest package
 from crick import TDigest
 
@@ -7,81 +15,498 @@ from crick import TDigest
 using one-pass algorithms
 """
 
-def two_pass_mean(data_chunk : xr.DataArray):
+def _time_first(data_chunk : xr.DataArray, time_axis : int = None):
+    """Returns the values of the data chunk as a numpy array with time
+    as the leading axis. If time_axis is not given it is looked up by
+    name for xr.DataArrays, numpy arrays are assumed to already have
+    time first.
+    """
+    if time_axis is None:
+        if not hasattr(data_chunk, "get_axis_num"):
+            return np.asarray(data_chunk)
+        time_axis = data_chunk.get_axis_num("time")
+
+    return np.moveaxis(np.asarray(data_chunk), time_axis, 0)
+
+def _spatial_shape(data_chunk : xr.DataArray):
+    """Shape of the data chunk without its time dimension, looked up by
+    name for xr.DataArrays, numpy arrays are assumed to have time first.
+    """
+    if hasattr(data_chunk, "get_axis_num"):
+        shape = list(data_chunk.shape)
+        del shape[data_chunk.get_axis_num("time")]
+        return tuple(shape)
+
+    return np.shape(data_chunk)[1:]
+
+def _as_block(data_chunk : xr.DataArray, w : int, time_axis : int = None):
+    """Returns the data chunk as a contiguous numpy array of shape
+    (w, N) with time as the leading axis and the spatial grid
+    flattened.
+    """
+    return np.ascontiguousarray(
+        _time_first(data_chunk, time_axis)
+    ).reshape(w, -1)
+
+def _as_state(state : np.ndarray):
+    """Returns the cumulative state as a numpy array together with a
+    flat view of it. float32 and float64 arrays are returned as they
+    are (so they are updated in place through the flat view, this also
+    holds for the views returned by init_var), anything else is
+    converted to float64.
+    """
+    state = np.asarray(state)
+    if state.dtype not in (np.float32, np.float64):
+        state = state.astype(np.float64)
+
+    state_flat = state.reshape(-1)
+    if not np.may_share_memory(state_flat, state):
+        # the reshape had to copy, so work on a contiguous copy instead
+        state = np.ascontiguousarray(state)
+        state_flat = state.reshape(-1)
+
+    return state, state_flat
+
+# one scratch buffer per thread, see _scratch_buffer
+_scratch = threading.local()
+
+def _scratch_buffer(shape : tuple, dtype : np.dtype):
+    """Scratch array of the chunk shape, kept so consecutive chunks of
+    the same shape reuse it. Each thread holds at most one buffer,
+    which is replaced when the shape or dtype changes.
+    """
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        # drop the old buffer before allocating the new one
+        _scratch.buffer = None
+        buffer = np.empty(shape, dtype=dtype)
+        _scratch.buffer = buffer
+
+    return buffer
+
+# long chunks are split into leaves shorter than TREE_VAR_LEAF_LENGTH
+# whose variances are combined pairwise (see _tree_var)
+TREE_VAR_MIN_LENGTH = 4096
+TREE_VAR_LEAF_LENGTH = 1024
+
+def _leaf_mean_M2(leaf : np.ndarray, dtype = np.float64):
+    """Mean, M2 and number of samples over the first axis of leaf"""
+    w = leaf.shape[0]
+    mean = leaf.mean(axis=0, dtype=dtype)
+    M2 = leaf.var(axis=0, dtype=dtype) * w
+
+    return mean, M2, w
+
+def _tree_var(data_chunk_values : np.ndarray, dtype = np.float64):
+    """Sample variance over the first axis of a long data chunk. The
+    time axis is split into a power of two number of leaves, whose
+    mean and M2 are computed in parallel threads (numpy releases the
+    GIL), then combined pairwise in a binary tree (combine_mean_var).
+    The rounding error then grows with log2 of the number of leaves
+    rather than with the chunk length.
+    """
+    w = data_chunk_values.shape[0]
+    num_leaves = 2 ** int(np.ceil(np.log2(w / TREE_VAR_LEAF_LENGTH)))
+    leaves = np.array_split(data_chunk_values, num_leaves, axis=0)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        stats = list(executor.map(_leaf_mean_M2, leaves, repeat(dtype)))
+
+    while len(stats) > 1:
+        stats = [
+            combine_mean_var(*stats_a, *stats_b)
+            for stats_a, stats_b in zip(stats[0::2], stats[1::2])
+        ]
+
+    _, M2, n = stats[0]
+
+    return M2 / (n - 1)
+
+def two_pass_mean(
+        data_chunk : xr.DataArray, dtype = np.float64,
+        time_axis : int = None
+    ):
     """Computes normal mean using numpy two pass
 
     Arguments
     ----------
-    data_chunk : xr.DataArray. incoming data chunk with a time
-            dimension greater than 1
+    data_chunk : xr.DataArray (or numpy array with time first).
+            incoming data chunk with a time dimension greater than 1
+    dtype : dtype used for the reduction, default np.float64
+    time_axis : index of the time dimension, looked up by name if not
+            given (pass it to skip the lookup on every chunk)
 
     Returns
     ---------
-    temp: xr.DataArray two-pass mean over the data chunk
+    temp: numpy array two-pass mean over the data chunk, without the
+            time dimension
     """
-    ax_num = data_chunk.get_axis_num("time")
-    temp = np.mean(data_chunk, axis=ax_num, dtype=np.float64, keepdims=True)
+    data_chunk_values = _time_first(data_chunk, time_axis)
+
+    temp = np.add.reduce(data_chunk_values, axis=0, dtype=dtype)
+    temp /= data_chunk_values.shape[0]
 
     return temp
 
-def two_pass_var(data_chunk : xr.DataArray):
+def two_pass_var(
+        data_chunk : xr.DataArray, dtype = np.float64,
+        time_axis : int = None
+    ):
     """Computes normal variance using numpy two pass,
     setting ddof = 1 for sample variance
 
     Arguments
     ----------
-    data_chunk : xr.DataArray. incoming data chunk with a time
-            dimension greater than 1
+    data_chunk : xr.DataArray (or numpy array with time first).
+            incoming data chunk with a time dimension greater than 1
+    dtype : dtype used for the reduction, default np.float64
+    time_axis : index of the time dimension, looked up by name if not
+            given (pass it to skip the lookup on every chunk)
 
     Returns
     ---------
-    temp: xr.DataArray two-pass variance over the data chunk
+    temp: numpy array two-pass variance over the data chunk, without
+            the time dimension
     """
-    ax_num = data_chunk.get_axis_num("time")
-    temp = np.var(
-        data_chunk, axis=ax_num, dtype=np.float64, keepdims=True, ddof=1
+    data_chunk_values = _time_first(data_chunk, time_axis)
+    w = data_chunk_values.shape[0]
+
+    if w >= TREE_VAR_MIN_LENGTH:
+        return _tree_var(data_chunk_values, dtype)
+
+    # squared deviations are written into a reused scratch buffer
+    scratch = _scratch_buffer(data_chunk_values.shape, np.dtype(dtype))
+    np.subtract(
+        data_chunk_values, two_pass_mean(data_chunk_values, dtype),
+        out=scratch
     )
+    np.square(scratch, out=scratch)
+
+    temp = np.add.reduce(scratch, axis=0)
+    temp /= (w - 1)
 
     return temp
 
+def _chunk_mean_w1(arr : np.ndarray, shape : tuple):
+    """Mean of a single time step data chunk (time first), returned as
+    a new float64 array of the given shape
+    """
+    return arr.reshape(shape).astype(np.float64)
+
+def _chunk_mean_wn(arr : np.ndarray, shape : tuple):
+    """Two pass mean of a data chunk (time first), returned as a new
+    float64 array of the given shape
+    """
+    return arr.mean(axis=0, dtype=np.float64).reshape(shape)
+
+def _update_mean_np(
+        delta : np.ndarray, w : int, n : int, mean_cumulative : np.ndarray,
+        mean_comp : np.ndarray = None
+    ):
+    """Updates the cumulative mean in place with the chunk mean delta
+    (from _chunk_mean_w1 or _chunk_mean_wn), which is used as the
+    scratch buffer. n is the count before this update. If mean_comp is
+    given the update is Kahan compensated and mean_comp is updated too.
+    If n is 0 the cumulative mean is seeded with the chunk mean without
+    being read.
+    """
+    if n == 0:
+        mean_cumulative[...] = delta
+        if mean_comp is not None:
+            np.subtract(mean_cumulative, delta, out=mean_comp)
+    elif mean_comp is None:
+        np.subtract(delta, mean_cumulative, out=delta)
+        np.multiply(delta, w / (n + w), out=delta)
+        np.add(mean_cumulative, delta, out=mean_cumulative)
+    else:
+        # delta is taken from the compensated mean (mean - comp)
+        np.subtract(delta, mean_cumulative, out=delta)
+        np.add(delta, mean_comp, out=delta)
+        np.multiply(delta, w / (n + w), out=delta)
+        np.subtract(delta, mean_comp, out=delta)
+        old_mean = mean_cumulative.copy()
+        np.add(mean_cumulative, delta, out=mean_cumulative)
+        # the rounding error of the store is carried to the next update
+        np.subtract(mean_cumulative, old_mean, out=mean_comp)
+        np.subtract(mean_comp, delta, out=mean_comp)
+
+@numba.njit(parallel=True, fastmath=True)
+def mean_step_kernel(x, n, mean):
+    """Updates the cumulative mean of every grid cell in place with a
+    single time step (w == 1), without any temporary arrays.
+
+    Arguments
+    ---------
+    x : flat contiguous numpy array of size N, the new time step
+    n : number of steps that has been added to the statistic, if 0
+            mean is not read (it can be uninitialised)
+    mean : flat cumulative mean of size N
+    """
+    if n == 0:
+        for j in numba.prange(x.shape[0]):
+            mean[j] = x[j]
+        return
+
+    inv_count = 1.0 / (n + 1)
+
+    for j in numba.prange(x.shape[0]):
+        mean[j] += (x[j] - mean[j]) * inv_count
+
+def _update_mean(
+        data_chunk_values : np.ndarray, w : int, n : int,
+        mean_cumulative : np.ndarray, mean_comp : np.ndarray, chunk_mean,
+        block_mean : np.ndarray = None
+    ):
+    """Updates the cumulative mean with the data chunk values (time
+    first), in place where possible, and returns it. chunk_mean is
+    _chunk_mean_w1 or _chunk_mean_wn, it is not called if the mean of
+    the chunk is given as block_mean.
+    """
+    mean_cumulative, mean_flat = _as_state(mean_cumulative)
+
+    if block_mean is not None:
+        # copied as _update_mean_np uses it as the scratch buffer
+        _update_mean_np(
+            np.array(block_mean, dtype=np.float64).reshape(
+                mean_cumulative.shape
+            ),
+            w, n, mean_cumulative, mean_comp
+        )
+    elif chunk_mean is _chunk_mean_w1 and mean_comp is None:
+        mean_step_kernel(
+            np.ascontiguousarray(data_chunk_values).reshape(-1), n,
+            mean_flat
+        )
+    else:
+        _update_mean_np(
+            chunk_mean(data_chunk_values, mean_cumulative.shape), w, n,
+            mean_cumulative, mean_comp
+        )
+
+    return mean_cumulative
+
 def update_mean(data_chunk : xr.DataArray, w : int, n : int,
-        mean_cumulative: xr.DataArray):
+        mean_cumulative: xr.DataArray, mean_comp : np.ndarray = None,
+        time_axis : int = None, block_mean : np.ndarray = None):
     """Computes one pass mean with w corresponding to the number
     of timesteps being added. Also updates n.
 
     Arguments
     ---------
-    data_chunk : incoming xr.DataArray data chunk
+    data_chunk : incoming xr.DataArray data chunk (or numpy array
+            with time first)
     w : length of time dimension of incoming data chunk
     n : number of steps that has been added to the statistic
-    mean_cumulative: cumulative mean
+    mean_cumulative: cumulative mean, float32 or float64 numpy arrays
+            are updated in place
+    mean_comp : optional Kahan compensation for mean_cumulative
+            (np.zeros_like(mean_cumulative) to start), updated in place.
+            Recommended when the cumulative mean is float32
+    time_axis : index of the time dimension, looked up by name if not
+            given
+    block_mean : optional mean of the data chunk over time (e.g. from
+            two_pass_mean) if the caller already has it, the data chunk
+            is then not read at all
 
     Returns
     ---------
     n : updated with w
     mean_cumulative: updated cumulative mean
     """
+    chunk_mean = _chunk_mean_w1 if w == 1 else _chunk_mean_wn
+    # the data chunk is not read (or computed, if dask backed) when its
+    # mean is given
+    if block_mean is None:
+        data_chunk_values = _time_first(data_chunk, time_axis)
+    else:
+        data_chunk_values = None
+
+    mean_cumulative = _update_mean(
+        data_chunk_values, w, n, mean_cumulative, mean_comp, chunk_mean,
+        block_mean
+    )
     n += w
 
-    if w > 1:
-        # compute two pass mean first
-        data_chunk = two_pass_mean(data_chunk)
+    return mean_cumulative, n
 
-    mean_cumulative = (mean_cumulative+ w * \
-        (data_chunk - mean_cumulative) / (
-        n
-    ))
+@numba.njit(fastmath=True)
+def _block_mean_M2(block, lo, hi, block_mean, block_M2):
+    """Mean and M2 over time of the grid cells lo to hi of a (w, N)
+    block, computed in a single sweep (Welford) into block_mean and
+    block_M2 (both of size hi - lo).
+    """
+    block_mean[:] = 0.0
+    block_M2[:] = 0.0
+
+    for t in range(block.shape[0]):
+        inv_count = 1.0 / (t + 1)
+        for j in range(lo, hi):
+            x = block[t, j]
+            delta = x - block_mean[j - lo]
+            block_mean[j - lo] += delta * inv_count
+            block_M2[j - lo] += delta * (x - block_mean[j - lo])
+
+@numba.njit(parallel=True, fastmath=True)
+def update_mean_var_kernel(block, n, mean, M2):
+    """Single pass update of the cumulative mean and M2 for every grid
+    cell, done in place. The grid is split into blocks of cells that
+    are processed in parallel. Each block streams through the rows of
+    the data chunk once to get the chunk mean and M2 (_block_mean_M2),
+    which are then combined with the cumulative values (see paper
+    Mastelini. S). For w == 1 this reduces to Welford's update.
 
-    return mean_cumulative, n
+    Arguments
+    ---------
+    block : contiguous numpy array of shape (w, N), time first
+    n : number of steps that has been added to the statistic
+    mean : flat cumulative mean of size N
+    M2 : flat cumulative M2 of size N
+
+    If n is 0 the state is seeded with the chunk statistics without
+    being read, so it can be uninitialised (see init_var).
+    """
+    w, size = block.shape
+    block_size = 1024
+    num_blocks = (size + block_size - 1) // block_size
+
+    weight = w / (n + w)
+    M2_weight = (n * w) / (n + w)
+
+    for b in numba.prange(num_blocks):
+        lo = b * block_size
+        hi = min(lo + block_size, size)
+
+        block_mean = np.empty(hi - lo)
+        block_M2 = np.empty(hi - lo)
+        _block_mean_M2(block, lo, hi, block_mean, block_M2)
+
+        if n == 0:
+            # first chunk seeds the state
+            mean[lo:hi] = block_mean
+            M2[lo:hi] = block_M2
+            continue
+
+        for j in range(lo, hi):
+            delta = block_mean[j - lo] - mean[j]
+            M2[j] += block_M2[j - lo] + delta * delta * M2_weight
+            mean[j] += delta * weight
+
+@numba.njit(parallel=True, fastmath=True)
+def welford_step_kernel(block, n, mean, M2):
+    """Welford update of the cumulative mean and M2 for every grid cell
+    with a single time step (w == 1), done in place. Same arguments as
+    update_mean_var_kernel, but without the chunk statistics.
+
+    Arguments
+    ---------
+    block : contiguous numpy array of shape (1, N)
+    n : number of steps that has been added to the statistic
+    mean : flat cumulative mean of size N
+    M2 : flat cumulative M2 of size N
+    """
+    if n == 0:
+        for j in numba.prange(block.shape[1]):
+            mean[j] = block[0, j]
+            M2[j] = 0.0
+        return
+
+    inv_count = 1.0 / (n + 1)
+
+    for j in numba.prange(block.shape[1]):
+        x = block[0, j]
+        delta = x - mean[j]
+        mean[j] += delta * inv_count
+        M2[j] += delta * (x - mean[j])
+
+@numba.njit(
+    parallel=True,
+    # no reassociation, it would optimise the compensation away
+    fastmath={"nnan", "ninf", "nsz", "arcp", "contract"},
+)
+def update_mean_var_kahan_kernel(block, n, mean, M2, mean_comp, M2_comp):
+    """Same as update_mean_var_kernel but the stores to mean and M2 are
+    Kahan compensated, for keeping the cumulative state in float32.
+    The chunk statistics and the combine are done in float64, only the
+    rounding of the stores is compensated.
+
+    Arguments
+    ---------
+    block : contiguous numpy array of shape (w, N), time first
+    n : number of steps that has been added to the statistic
+    mean : flat cumulative mean of size N
+    M2 : flat cumulative M2 of size N
+    mean_comp : flat compensation of the cumulative mean of size N
+    M2_comp : flat compensation of the cumulative M2 of size N
+    """
+    w, size = block.shape
+    block_size = 1024
+    num_blocks = (size + block_size - 1) // block_size
+
+    weight = w / (n + w)
+    M2_weight = (n * w) / (n + w)
+
+    for b in numba.prange(num_blocks):
+        lo = b * block_size
+        hi = min(lo + block_size, size)
+
+        block_mean = np.empty(hi - lo)
+        block_M2 = np.empty(hi - lo)
+        _block_mean_M2(block, lo, hi, block_mean, block_M2)
+
+        if n == 0:
+            # first chunk seeds the state, the compensation holds the
+            # rounding of the seed
+            for j in range(lo, hi):
+                mean[j] = block_mean[j - lo]
+                mean_comp[j] = np.float64(mean[j]) - block_mean[j - lo]
+                M2[j] = block_M2[j - lo]
+                M2_comp[j] = np.float64(M2[j]) - block_M2[j - lo]
+            continue
+
+        for j in range(lo, hi):
+            delta = block_mean[j - lo] - (np.float64(mean[j]) - mean_comp[j])
+
+            y = block_M2[j - lo] + delta * delta * M2_weight - M2_comp[j]
+            old = np.float64(M2[j])
+            M2[j] = old + y
+            M2_comp[j] = (np.float64(M2[j]) - old) - y
+
+            y = delta * weight - mean_comp[j]
+            old = np.float64(mean[j])
+            mean[j] = old + y
+            mean_comp[j] = (np.float64(mean[j]) - old) - y
+
+def _update_var_np(
+        block : np.ndarray, n : int, mean_cumulative : np.ndarray,
+        var_cumulative : np.ndarray, mean_comp : np.ndarray,
+        var_comp : np.ndarray, kernel
+    ):
+    """Runs the variance kernel on a (w, N) block, updating the
+    cumulative state in place where possible, and returns the state
+    """
+    mean_cumulative, mean_flat = _as_state(mean_cumulative)
+    var_cumulative, var_flat = _as_state(var_cumulative)
+
+    if mean_comp is None:
+        kernel(block, n, mean_flat, var_flat)
+    else:
+        update_mean_var_kahan_kernel(
+            block, n, mean_flat, var_flat, mean_comp.reshape(-1),
+            var_comp.reshape(-1)
+        )
+
+    return mean_cumulative, var_cumulative
 
 def update_var(
         data_chunk : xr.DataArray, w : int, n : int,
-        mean_cumulative: xr.DataArray, var_cumulative: xr.DataArray
+        mean_cumulative: xr.DataArray, var_cumulative: xr.DataArray,
+        mean_comp : np.ndarray = None, var_comp : np.ndarray = None,
+        time_axis : int = None
     ):
     """Computes one pass variance with w corresponding to
-    the number of timesteps being added. It does not update
-    the n as this is done in update_mean which update_var
-    calls.
+    the number of timesteps being added. The mean, variance and n
+    are all updated together in a single pass over the data chunk
+    (see welford_step_kernel and update_mean_var_kernel).
 
     Arguments
     ---------
@@ -90,72 +515,148 @@ def update_var(
     n : current number of samples that have contributed to the variance
     mean_cumulative: cumulative mean of the streamed data
     var_cumulative : cumulative variance of the streamed data
-
+    mean_comp, var_comp : optional Kahan compensation for the mean and
+            variance (np.zeros_like to start), updated in place. Both
+            or neither should be given, recommended when the cumulative
+            state is float32
+    time_axis : index of the time dimension, looked up by name if not
+            given
 
     Returns
     ---------
+    n : updated with w
+    mean_cumulative: updated cumulative mean
     var_cumulative: updated cumulative variance. If n < c
             and the statistic is not complete, this is equal to M2
             (see docs). If n == c and enough samples have been
             addded var_cumulativeis divded by (n-1) to get actual variance.
     """
 
-    # storing 'old' mean temporarily
-    old_mean = mean_cumulative
+    kernel = welford_step_kernel if w == 1 else update_mean_var_kernel
 
-    if w == 1 :
+    # the state is updated in place by the kernel
+    mean_cumulative, var_cumulative = _update_var_np(
+        _as_block(data_chunk, w, time_axis), n, mean_cumulative,
+        var_cumulative, mean_comp, var_comp, kernel
+    )
+    n += w
 
-        mean_cumulative, n = update_mean(data_chunk, w, n, mean_cumulative)
+    return n, mean_cumulative, var_cumulative
 
-        var_cumulative = var_cumulative+ w * (
-            data_chunk - old_mean) * (data_chunk - mean_cumulative)
 
-    else:
-        # two-pass mean
-        temp_mean = two_pass_mean(data_chunk)
-        # two pass variance
-        temp_var = (two_pass_var(data_chunk)) * (w - 1)
-        # see paper Mastelini. S
-
-        var_cumulative= (
-            var_cumulative
-            + temp_var
-            + np.square(old_mean - temp_mean)
-            * ((n * w) / (n + w))
-        )
+@numba.guvectorize(
+    [
+        "(float32[:], float64[:], float64[:], int64[:])",
+        "(float64[:], float64[:], float64[:], int64[:])",
+    ],
+    "(t)->(),(),()",
+)
+def _welford_1d(ts, mean, M2, n):
+    """Welford mean, M2 and number of samples of a single time series"""
+    mean_t = 0.0
+    M2_t = 0.0
+    for t in range(ts.shape[0]):
+        delta = ts[t] - mean_t
+        mean_t += delta / (t + 1)
+        M2_t += delta * (ts[t] - mean_t)
+
+    mean[0] = mean_t
+    M2[0] = M2_t
+    n[0] = ts.shape[0]
+
+def welford_chunk(data_chunk : xr.DataArray):
+    """Computes the mean, M2 and number of samples over the time
+    dimension of the data chunk with xr.apply_ufunc. Dask backed data
+    chunks stay lazy and are computed in parallel, one task per
+    spatial block (time must be a single dask chunk). Combine the
+    result with the cumulative statistics using combine_mean_var.
 
-        mean_cumulative, n = update_mean(data_chunk, w, n, mean_cumulative)
+    Arguments
+    ---------
+    data_chunk : incoming xr.DataArray data chunk
 
-    return n, mean_cumulative, var_cumulative
+    Returns
+    ---------
+    mean : xr.DataArray mean of the data chunk
+    M2 : xr.DataArray M2 of the data chunk
+    n : xr.DataArray number of samples in the data chunk
+    """
+    return xr.apply_ufunc(
+        _welford_1d, data_chunk,
+        input_core_dims=[["time"]],
+        output_core_dims=[[], [], []],
+        dask="parallelized",
+        output_dtypes=[np.float64, np.float64, np.int64],
+    )
 
+def combine_mean_var(mean_a, M2_a, n_a, mean_b, M2_b, n_b):
+    """Combines two sets of mean, M2 and number of samples (see
+    paper Mastelini. S), for instance the cumulative statistics and
+    the output of welford_chunk. Works on numpy arrays, xr.DataArrays
+    and dask arrays alike.
+
+    Arguments
+    ---------
+    mean_a, M2_a, n_a : first mean, M2 and number of samples
+    mean_b, M2_b, n_b : second mean, M2 and number of samples
 
-def init_mean(data_chunk : xr.DataArray):
+    Returns
+    ---------
+    mean : combined mean
+    M2 : combined M2, divide by (n-1) to get the variance
+    n : combined number of samples
+    """
+    n = n_a + n_b
+    delta = mean_b - mean_a
+
+    mean = mean_a + delta * (n_b / n)
+    M2 = M2_a + M2_b + delta * delta * (n_a * n_b / n)
+
+    return mean, M2, n
+
+def init_mean(
+        data_chunk : xr.DataArray, dtype = np.float64,
+        spatial_shape : tuple = None
+    ):
     
     """Function to initalise an empty numpy array of the same shape
     as the spatial grid, to store the cumulative mean
 
     Arguments 
     ----------
-    data_chunk : incoming xr.DataArray data chunk
+    data_chunk : incoming xr.DataArray data chunk (or numpy array
+            with time first)
+    dtype : dtype of the cumulative mean, default np.float64. np.float32
+            halves the memory of the state, use with a Kahan
+            compensation array in update_mean
+    spatial_shape : shape of the cumulative mean, if given data_chunk
+            is not inspected (and can be None)
 
     Returns
     ---------
     mean_cumulative : an empty numpy array of the same shape as the
-            spatial grid of the data chunk (compressed in the time 
-            dimension) for storing the cumulative mean
+            spatial grid of the data chunk (without the time
+            dimension) for storing the cumulative mean. Its contents
+            are undefined until the first update_mean call (n == 0)
     """
 
-    data_chunk_tail = data_chunk.tail(time=1)
-    shape_data_chunk_tail = np.shape(data_chunk_tail)
+    if spatial_shape is None:
+        shape_data_chunk_tail = _spatial_shape(data_chunk)
+    else:
+        shape_data_chunk_tail = tuple(spatial_shape)
 
-    # initialise cumulative mean and cumulative standard deviation
-    mean_cumulative = np.zeros(
-            shape_data_chunk_tail, dtype=np.float64
+    # initialise cumulative mean, left uninitialised as the first
+    # update (n == 0) seeds it
+    mean_cumulative = np.empty(
+            shape_data_chunk_tail, dtype=dtype
         )
 
     return mean_cumulative
 
-def init_var(data_chunk : xr.DataArray):
+def init_var(
+        data_chunk : xr.DataArray, dtype = np.float64,
+        spatial_shape : tuple = None
+    ):
     
     """Function to initalise two empty numpy arrays of the same shape
     as the spatial grid, to store the cumulative mean and variance
@@ -164,30 +665,39 @@ def init_var(data_chunk : xr.DataArray):
     ----------
     data_chunk : incoming xr.DataArray data chunk(or in some cases
             numpy array)
+    dtype : dtype of the cumulative state, default np.float64. np.float32
+            halves the memory of the state, use with Kahan compensation
+            arrays in update_var
+    spatial_shape : shape of the cumulative state, if given data_chunk
+            is not inspected (and can be None)
 
     Returns
     ---------
     mean_cumulative : an empty numpy array of the same shape as the
-            spatial grid of the data chunk (compressed in the time 
+            spatial grid of the data chunk (without the time
             dimension) for storing the cumulative mean
     var_cumulative : an empty numpy array of the same shape as the
-            spatial grid of the data chunk (compressed in the time 
+            spatial grid of the data chunk (without the time
             dimension) for storing the cumulative variance
+
+    Both are contiguous halves of one (2, ...) array, so the kernels
+    read each of them with unit stride. Their contents are undefined
+    until the first update_var call (n == 0).
     """
 
-    if type(data_chunk) == xr.DataArray:
-        data_chunk_tail = data_chunk.tail(time=1)
-        shape_data_chunk_tail = np.shape(data_chunk_tail)
+    if spatial_shape is None:
+        shape_data_chunk_tail = _spatial_shape(data_chunk)
     else:
-        shape_data_chunk_tail = np.shape(data_chunk)[1:]
+        shape_data_chunk_tail = tuple(spatial_shape)
 
-    # initialise cumulative mean and cumulative standard deviation
-    mean_cumulative = np.zeros(
-            shape_data_chunk_tail, dtype=np.float64
-        )
-    var_cumulative = np.zeros(
-            shape_data_chunk_tail, dtype=np.float64
+    # initialise cumulative mean and cumulative standard deviation in
+    # one allocation, left uninitialised as the first update (n == 0)
+    # seeds them
+    state = np.empty(
+            (2,) + shape_data_chunk_tail, dtype=dtype
         )
+    mean_cumulative = state[0]
+    var_cumulative = state[1]
 
     return mean_cumulative, var_cumulative
 
@@ -229,13 +739,21 @@ def calc_std(var_cumulative : xr.DataArray, n : int):
         """
 
         if (n - 1) != 0:
-            var_cumulative = divide_by_sample_size(var_cumulative, n)
+            std_cumulative = divide_by_sample_size(var_cumulative, n)
 
-            std_cumulative = np.sqrt(var_cumulative)
+            # square root in place for numpy arrays, divide_by_sample_size
+            # has already allocated the new array
+            if isinstance(std_cumulative, np.ndarray):
+                std_cumulative = np.sqrt(std_cumulative, out=std_cumulative)
+            else:
+                std_cumulative = np.sqrt(std_cumulative)
 
         return std_cumulative
 
-def init_tdigests(data_chunk : xr.DataArray, compression = 60):
+def init_tdigests(
+        data_chunk : xr.DataArray, compression = 60,
+        spatial_shape : tuple = None
+    ):
         """Function to initalise a flat array full of empty 
         tDigest objects.
 
@@ -243,6 +761,8 @@ def init_tdigests(data_chunk : xr.DataArray, compression = 60):
         ----------
         data_chunk : incoming xr.DataArray data chunk
         compression : compression value for the digests, default 60
+        spatial_shape : shape of the spatial grid, if given data_chunk
+                is not inspected (and can be None)
 
         Returns
         ---------
@@ -251,34 +771,97 @@ def init_tdigests(data_chunk : xr.DataArray, compression = 60):
         size_data_chunk_tail : size of global grid without time dimension
         """
         
-        if type(data_chunk) == xr.DataArray:
-            data_chunk_tail = data_chunk.tail(time=1)
-            size_data_chunk_tail = np.size(data_chunk_tail)
-        else:
-            size_data_chunk_tail = np.size(data_chunk[0,:])
-
-        #data_source_tail = data_chunk.tail(time=1)
-        #size_data_chunk_tail = np.size(data_source_tail)
-
-        # list of dictionaries for each grid cell, preserves order
-        digest_list = [{} for _ in range(
-                size_data_chunk_tail
-            )]
-        # converts the list into a numpy array which helps with re-sizing time
-        digest_list = np.reshape(
-                digest_list, size_data_chunk_tail
-            )
+        if spatial_shape is None:
+            spatial_shape = _spatial_shape(data_chunk)
+        size_data_chunk_tail = int(np.prod(spatial_shape))
+
+        # flat object array for each grid cell, preserves order
+        digest_list = np.empty(size_data_chunk_tail, dtype=object)
 
         for j in range(size_data_chunk_tail):
             digest_list[j] = TDigest(compression=compression)
 
         return digest_list, size_data_chunk_tail
 
+# crick only releases the GIL while it adds arrays longer than 500
+# values, shorter rows are added on the calling thread
+TDIGEST_NOGIL_MIN_LENGTH = 501
+
+def _update_digest_slice(
+        digest_list : list, data_chunk_values : np.ndarray,
+        start : int, stop : int
+    ):
+    """Updates the digests of grid cells start to stop with their row
+    of data_chunk_values (shape (N, w))
+    """
+    for j in range(start, stop):
+        # using crick
+        digest_list[j].update(data_chunk_values[j])
+
+def _update_tdigests_w1(
+        data_chunk : np.ndarray, size_data_chunk_tail : int,
+        digest_list : list
+    ):
+    """Adds a single time step to the digest of every grid cell"""
+    data_chunk_values = np.reshape(
+        data_chunk, size_data_chunk_tail
+    ).tolist()
+
+    # this is looping through every grid cell, the scalar add
+    # skips the array checks crick does on every call to update
+    for digest, value in zip(digest_list, data_chunk_values):
+        digest.add(value)
+
+def _update_tdigests_wn(
+        data_chunk : np.ndarray, size_data_chunk_tail : int,
+        digest_list : list, w : int, num_threads : int = None
+    ):
+    """Adds w time steps to the digest of every grid cell, split
+    between num_threads threads (default os.cpu_count())
+    """
+    # one contiguous row of w values per grid cell, sorted so crick's
+    # buffer flushes merge runs that are already in order
+    data_chunk_values = np.ascontiguousarray(
+        np.reshape(data_chunk, [w, -1]).T
+    )
+    data_chunk_values.sort(axis=1)
+
+    num_threads = num_threads or os.cpu_count() or 1
+
+    if w < TDIGEST_NOGIL_MIN_LENGTH or num_threads == 1:
+        # threads would only take turns holding the GIL
+        _update_digest_slice(
+            digest_list, data_chunk_values, 0, size_data_chunk_tail
+        )
+        return
+
+    # grid cells are independent so they are split between threads,
+    # crick releases the GIL while it adds long arrays
+    bounds = np.linspace(
+        0, size_data_chunk_tail, num_threads + 1, dtype=int
+    )
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [
+            executor.submit(
+                _update_digest_slice, digest_list, data_chunk_values,
+                start, stop
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        for future in futures:
+            future.result()
+
 def update_tdigests(
         data_chunk : xr.DataArray, size_data_chunk_tail : int,
-        digest_list : list, n : int,  w : int = 1
+        digest_list : list, n : int,  w : int = 1,
+        time_axis : int = None
     ):
-    """Sequential loop that updates the digest for each grid point.
+    """Updates the digest for each grid point. A single time step is
+    added value by value in a loop over the grid cells. Longer chunks
+    are transposed to one row per grid cell and each row is sorted
+    before it is added. When w is at least TDIGEST_NOGIL_MIN_LENGTH
+    the grid cells are split between threads (crick releases the GIL
+    for rows that long), otherwise they are added in a loop.
     If the statistic is not bias correction, it will also update the
     n with the w. For bias correction, this is done in the
     daily means calculation.
@@ -291,6 +874,8 @@ def update_tdigests(
         full of empty t digest objects with compression = 60
     n : current number of samples that have contributed to the statistic
     w : length of time dimension of incoming data chunk
+    time_axis : index of the time dimension, looked up by name if not
+            given
 
     Returns
     ---------
@@ -298,28 +883,552 @@ def update_tdigests(
             the new data
     n : updated with w
     """
+    data_chunk_values = _time_first(data_chunk, time_axis)
+
     if w == 1:
+        _update_tdigests_w1(
+            data_chunk_values, size_data_chunk_tail, digest_list
+        )
+    else:
+        _update_tdigests_wn(
+            data_chunk_values, size_data_chunk_tail, digest_list, w
+        )
+
+    n += w
+
+    return n, digest_list
 
-        data_chunk_values = np.reshape(
-            data_chunk, size_data_chunk_tail
+def _check_chunk_length(data_chunk_values : np.ndarray, w : int):
+    """Raises a ValueError if the data chunk (time first) does not have
+    w time steps, as expected by an updater from make_updater
+    """
+    if data_chunk_values.shape[0] != w:
+        raise ValueError(
+            f"updater was made for data chunks with {w} time steps, got "
+            f"{data_chunk_values.shape[0]}, use another updater (or the "
+            "update_* function) for a chunk of a different length"
         )
 
-        iterable = range(size_data_chunk_tail)
-        # this is looping through every grid cell
-        for j in iterable:
-            digest_list[j].update(
-                data_chunk_values[j]
+def make_updater(
+        w : int, statistic : str = "var", time_axis : int = None
+    ):
+    """Returns an update function specialised for data chunks with a
+    time dimension of length w, so the w == 1 / w > 1 choice is made
+    once at the start of the stream rather than on every chunk. The
+    returned function takes the same arguments as the matching
+    update_* function without w, and returns the same values.
+
+    Every data chunk has to have exactly w time steps, otherwise the
+    updater raises a ValueError. If the stream length is not a multiple
+    of w, update the trailing partial chunk with a second updater made
+    for its length (or with the update_* function).
+
+    Arguments
+    ---------
+    w : length of time dimension of every incoming data chunk
+    statistic : "mean", "var" or "tdigest", default "var"
+    time_axis : index of the time dimension of every incoming data
+            chunk, e.g. data_chunk.get_axis_num("time") of the first
+            chunk, so it is not looked up on every chunk
+
+    Returns
+    ---------
+    updater : for "mean", updater(data_chunk, n, mean_cumulative,
+            mean_comp=None) -> mean_cumulative, n
+            for "var", updater(data_chunk, n, mean_cumulative,
+            var_cumulative, mean_comp=None, var_comp=None)
+            -> n, mean_cumulative, var_cumulative
+            for "tdigest", updater(data_chunk, size_data_chunk_tail,
+            digest_list, n) -> n, digest_list
+    """
+    if statistic == "mean":
+        chunk_mean = _chunk_mean_w1 if w == 1 else _chunk_mean_wn
+
+        def updater(data_chunk, n, mean_cumulative, mean_comp=None):
+            data_chunk_values = _time_first(data_chunk, time_axis)
+            _check_chunk_length(data_chunk_values, w)
+            mean_cumulative = _update_mean(
+                data_chunk_values, w, n, mean_cumulative, mean_comp,
+                chunk_mean
             )
+            return mean_cumulative, n + w
+
+    elif statistic == "var":
+        kernel = welford_step_kernel if w == 1 else update_mean_var_kernel
+
+        def updater(
+                data_chunk, n, mean_cumulative, var_cumulative,
+                mean_comp=None, var_comp=None
+            ):
+            data_chunk_values = _time_first(data_chunk, time_axis)
+            _check_chunk_length(data_chunk_values, w)
+            mean_cumulative, var_cumulative = _update_var_np(
+                _as_block(data_chunk_values, w), n, mean_cumulative,
+                var_cumulative, mean_comp, var_comp, kernel
+            )
+            return n + w, mean_cumulative, var_cumulative
+
+    elif statistic == "tdigest":
+        if w == 1:
+            update = _update_tdigests_w1
+        else:
+            update = partial(_update_tdigests_wn, w=w)
+
+        def updater(data_chunk, size_data_chunk_tail, digest_list, n):
+            data_chunk_values = _time_first(data_chunk, time_axis)
+            _check_chunk_length(data_chunk_values, w)
+            update(data_chunk_values, size_data_chunk_tail, digest_list)
+            return n + w, digest_list
 
     else:
-        data_chunk_values = np.reshape(data_chunk,[w, -1])
-        iterable = range(size_data_chunk_tail)
-        for j in iterable:
-            # using crick
-            digest_list[j].update(
-                data_chunk_values[:, j]
+        raise ValueError(
+            f"statistic must be 'mean', 'var' or 'tdigest', not {statistic}"
+        )
+
+    return updater
+
+def _merge_digest_pair(digest_a : TDigest, digest_b : TDigest):
+    """Merges digest_b into digest_a in place and returns digest_a"""
+    digest_a.merge(digest_b)
+    return digest_a
+
+# element-wise merge of two flat arrays of digests
+_merge_digest_arrays = np.frompyfunc(_merge_digest_pair, 2, 1)
+
+def merge_digest_grids(digest_grids : list):
+    """Combines a list of digest arrays (one t-digest per grid cell,
+    as returned by init_tdigests) into a single digest array. The
+    arrays are merged pairwise in a binary tree, so the result is
+    built with log2(len(digest_grids)) rounds of merges. The first
+    array of each pair is updated in place.
+
+    Arguments
+    ---------
+    digest_grids : list of flat arrays of t digest objects, all for the
+            same spatial grid
+
+    Returns
+    ---------
+    digest_list: flat array of t digest objects holding the data of
+            all the input digests
+    """
+    digest_grids = list(digest_grids)
+    if not digest_grids:
+        raise ValueError(
+            "merge_digest_grids needs at least one digest array"
+        )
+
+    while len(digest_grids) > 1:
+        merged = [
+            _merge_digest_arrays(digest_a, digest_b)
+            for digest_a, digest_b in zip(
+                digest_grids[0::2], digest_grids[1::2]
             )
+        ]
+        # odd one out is carried to the next round
+        if len(digest_grids) % 2:
+            merged.append(digest_grids[-1])
+        digest_grids = merged
+
+    return digest_grids[0]
+
+def _chunk_tdigests(data_chunk : np.ndarray, compression : int):
+    """Builds the digest array of a single data chunk. The chunk
+    already has a worker process to itself, so its digests are updated
+    on a single thread rather than opening another pool per process.
+    """
+    w = np.shape(data_chunk)[0]
+    digest_list, size_data_chunk_tail = init_tdigests(
+        data_chunk, compression
+    )
 
-    n += w
+    if w == 1:
+        _update_tdigests_w1(data_chunk, size_data_chunk_tail, digest_list)
+    else:
+        _update_tdigests_wn(
+            data_chunk, size_data_chunk_tail, digest_list, w, num_threads=1
+        )
+
+    return digest_list
+
+def parallel_tdigests(
+        data_chunks : list, compression = 60, max_workers : int = None
+    ):
+    """Builds the t-digests of several data chunks at once. Each chunk
+    gets its own digest array in a separate process, these are then
+    combined with merge_digest_grids. Gives the same digests as
+    streaming the chunks through update_tdigests one after the other,
+    up to the ordering of the t-digest merges.
+
+    Arguments
+    ---------
+    data_chunks : list of numpy arrays, each with time as the first
+            dimension
+    compression : compression value for the digests, default 60
+    max_workers : number of processes, default os.cpu_count(), each
+            updates its digests on a single thread
+
+    Returns
+    ---------
+    n : number of samples that have contributed to the digests
+    digest_list: each digest for each grid cell is updated with
+            the data from every chunk
+    """
+    n = sum(np.shape(data_chunk)[0] for data_chunk in data_chunks)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        digest_grids = list(executor.map(
+            _chunk_tdigests, data_chunks, repeat(compression)
+        ))
+
+    return n, merge_digest_grids(digest_grids)
+
+@numba.njit
+def _count_buckets(counts, cells, columns):
+    """Adds one to counts[cells[i], columns[i]] for every i"""
+    for i in range(cells.shape[0]):
+        counts[cells[i], columns[i]] += 1
+
+class _BucketStore:
+    """Counts of logarithmic buckets for every grid cell, stored as a
+    dense (N, max_buckets) array. All grid cells share the same window
+    of bucket keys [offset, offset + max_buckets) so every operation
+    is vectorised over the grid.
+    """
+
+    def __init__(self, size : int, max_buckets : int):
+        self.counts = np.zeros((size, max_buckets), dtype=np.uint32)
+        self.offset = 0
+        # range of keys that have been counted, None while empty
+        self.key_lo = None
+        self.key_hi = None
+
+    def key_range(self, keys : np.ndarray):
+        """Range of keys after adding keys"""
+        key_lo, key_hi = int(keys.min()), int(keys.max())
+        if self.key_lo is not None:
+            key_lo = min(key_lo, self.key_lo)
+            key_hi = max(key_hi, self.key_hi)
+
+        return key_lo, key_hi
+
+    def collapse(self):
+        """Merges pairs of adjacent buckets, key k goes to ceil(k / 2)"""
+        max_buckets = self.counts.shape[1]
+        new_keys = -((-(self.offset + np.arange(max_buckets))) // 2)
+        new_offset = int(new_keys[0])
+        # first column of every run of old buckets that share a new key
+        starts = np.flatnonzero(np.diff(new_keys, prepend=new_offset - 1))
+        merged = np.add.reduceat(self.counts, starts, axis=1)
+
+        self.counts[:] = 0
+        self.counts[:, :merged.shape[1]] = merged
+        self.offset = new_offset
+        if self.key_lo is not None:
+            self.key_lo = -(-self.key_lo // 2)
+            self.key_hi = -(-self.key_hi // 2)
+
+    def shift(self, key_lo : int):
+        """Moves the window of keys so it starts at key_lo"""
+        max_buckets = self.counts.shape[1]
+        move = self.offset - key_lo
+        if move == 0:
+            return
+
+        counts = np.zeros_like(self.counts)
+        if abs(move) < max_buckets:
+            if move > 0:
+                counts[:, move:] = self.counts[:, :max_buckets - move]
+            else:
+                counts[:, :move] = self.counts[:, -move:]
+        self.counts = counts
+        self.offset = key_lo
+
+    def add(self, cells : np.ndarray, keys : np.ndarray):
+        """Counts one sample of key keys[i] in grid cell cells[i]"""
+        _count_buckets(self.counts, cells, keys - self.offset)
+        self.key_lo, self.key_hi = self.key_range(keys)
+
+class UDDSketchGrid:
+    """UDDSketch (uniform collapse DDSketch) for every cell of a flat
+    spatial grid. Values go into logarithmic buckets of relative width
+    alpha, so an update is a log and a bucket count for the whole data
+    chunk at once rather than one call per grid cell. All grid cells
+    share one window of keys, so when the keys of any grid cell no
+    longer fit in max_buckets the buckets of every grid cell are merged
+    in pairs, which squares gamma (roughly doubles alpha) for the whole
+    grid. Values smaller in magnitude than min_value are counted as
+    zero (as the minimum indexable value of DDSketch), so a few tiny
+    values do not widen the window. Sketches are mergeable, see merge.
 
-    return n, digest_list
\ No newline at end of file
+    Arguments
+    ---------
+    size : number of grid cells
+    alpha : initial relative accuracy of the quantiles, default 0.01
+    max_buckets : number of buckets per grid cell for each sign,
+            default 256
+    min_value : smallest magnitude that is bucketed, default 1e-8,
+            smaller values are reported as 0. Lower it for data whose
+            quantiles of interest are smaller than this
+    """
+
+    def __init__(
+            self, size : int, alpha : float = 0.01, max_buckets : int = 256,
+            min_value : float = 1e-8
+        ):
+        self.size = size
+        self.max_buckets = max_buckets
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = _BucketStore(size, max_buckets)
+        # only allocated if negative values are seen
+        self.negative = None
+        self.zero_counts = np.zeros(size, dtype=np.uint32)
+
+    @property
+    def alpha(self):
+        """Current relative accuracy of the quantiles"""
+        return (self.gamma - 1) / (self.gamma + 1)
+
+    def _stores(self):
+        return [
+            store for store in (self.positive, self.negative)
+            if store is not None
+        ]
+
+    def _collapse(self):
+        for store in self._stores():
+            store.collapse()
+        self.gamma = self.gamma ** 2
+
+    def _keys(self, values : np.ndarray):
+        return np.ceil(np.log(values) / np.log(self.gamma)).astype(np.int64)
+
+    def _add(self, store : _BucketStore, cells : np.ndarray,
+            values : np.ndarray):
+        """Adds positive values to store, collapsing and moving the
+        window of keys as needed
+        """
+        keys = self._keys(values)
+        key_lo, key_hi = store.key_range(keys)
+        while key_hi - key_lo >= self.max_buckets:
+            self._collapse()
+            keys = -(-keys // 2)
+            key_lo, key_hi = store.key_range(keys)
+
+        window_hi = store.offset + self.max_buckets
+        if key_lo < store.offset or key_hi >= window_hi:
+            store.shift(key_lo)
+        store.add(cells, keys)
+
+    def update(self, data_chunk_values : np.ndarray):
+        """Adds a data chunk of shape (w, N), time first, to the
+        sketches. NaNs and infinities are skipped, as crick does.
+        """
+        values = np.reshape(data_chunk_values, (-1, self.size))
+        cells = np.broadcast_to(np.arange(self.size), values.shape)
+
+        # an infinite value would get an unbounded key
+        finite = np.isfinite(values)
+
+        positive = finite & (values >= self.min_value)
+        if positive.any():
+            self._add(self.positive, cells[positive], values[positive])
+
+        negative = finite & (values <= -self.min_value)
+        if negative.any():
+            if self.negative is None:
+                self.negative = _BucketStore(self.size, self.max_buckets)
+            self._add(self.negative, cells[negative], -values[negative])
+
+        zero = finite & (np.abs(values) < self.min_value)
+        self.zero_counts += np.count_nonzero(zero, axis=0).astype(
+            np.uint32
+        )
+
+    def merge(self, other : "UDDSketchGrid"):
+        """Adds the counts of other (same grid size) to these sketches
+        in place, collapsing whichever has the finer buckets first.
+        Raises a ValueError, before changing either sketch, if the grid
+        size, max_buckets or min_value differ or if neither gamma can be
+        collapsed into the other (gammas built from unrelated alphas).
+        """
+        if (
+                other.size != self.size
+                or other.max_buckets != self.max_buckets
+                or other.min_value != self.min_value
+            ):
+            raise ValueError(
+                "UDDSketchGrids can only be merged with the same size, "
+                "max_buckets and min_value"
+            )
+
+        # every collapse squares gamma, so one log(gamma) has to be a
+        # power of two times the other
+        num_collapses = np.log2(np.log(other.gamma) / np.log(self.gamma))
+        if not np.isclose(num_collapses, np.round(num_collapses)):
+            raise ValueError(
+                f"UDDSketchGrids with alpha {self.alpha} and {other.alpha} "
+                "cannot be merged, their gammas are not collapses of "
+                "each other"
+            )
+
+        other = copy.deepcopy(other)
+        while not np.isclose(self.gamma, other.gamma):
+            if self.gamma < other.gamma:
+                self._collapse()
+            else:
+                other._collapse()
+
+        if other.negative is not None and self.negative is None:
+            self.negative = _BucketStore(self.size, self.max_buckets)
+
+        pairs = [
+            (store, other_store) for store, other_store in (
+                (self.positive, other.positive),
+                (self.negative, other.negative)
+            )
+            if other_store is not None and other_store.key_lo is not None
+        ]
+
+        # both sketches are collapsed until the keys of each sign fit
+        def too_wide():
+            for store, other_store in pairs:
+                key_lo, key_hi = store.key_range(
+                    np.array([other_store.key_lo, other_store.key_hi])
+                )
+                if key_hi - key_lo >= self.max_buckets:
+                    return True
+            return False
+
+        while too_wide():
+            self._collapse()
+            other._collapse()
+
+        for store, other_store in pairs:
+            key_lo, key_hi = store.key_range(
+                np.array([other_store.key_lo, other_store.key_hi])
+            )
+            store.shift(key_lo)
+            other_store.shift(key_lo)
+            store.counts += other_store.counts
+            store.key_lo, store.key_hi = key_lo, key_hi
+
+        self.zero_counts += other.zero_counts
+
+        return self
+
+    def count(self):
+        """Number of samples in the sketch of each grid cell"""
+        total = self.zero_counts.astype(np.int64)
+        for store in self._stores():
+            total = total + store.counts.sum(axis=1, dtype=np.int64)
+
+        return total
+
+    def quantile(self, q : float):
+        """Estimate of the q quantile (0 <= q <= 1) for each grid cell,
+        NaN for grid cells without any samples
+        """
+        # buckets in increasing order of value: negative buckets from
+        # the largest magnitude down, zero, then positive buckets
+        columns = []
+        values = []
+        if self.negative is not None:
+            keys = self.negative.offset + np.arange(self.max_buckets)
+            columns.append(self.negative.counts[:, ::-1])
+            values.append(-self._bucket_values(keys)[::-1])
+        columns.append(self.zero_counts[:, None])
+        values.append(np.zeros(1))
+        keys = self.positive.offset + np.arange(self.max_buckets)
+        columns.append(self.positive.counts)
+        values.append(self._bucket_values(keys))
+
+        cumulative = np.cumsum(np.hstack(columns), axis=1, dtype=np.int64)
+        values = np.concatenate(values)
+
+        total = cumulative[:, -1]
+        rank = q * (total - 1)
+        index = np.count_nonzero(cumulative <= rank[:, None], axis=1)
+        index = np.minimum(index, len(values) - 1)
+
+        return np.where(total > 0, values[index], np.nan)
+
+    def _bucket_values(self, keys : np.ndarray):
+        """Value reported for bucket key k, 2 gamma^k / (gamma + 1)"""
+        return 2 * self.gamma ** keys.astype(np.float64) / (self.gamma + 1)
+
+def init_sketches(
+        data_chunk : xr.DataArray, backend : str = "tdigest",
+        compression = 60, alpha : float = 0.01, max_buckets : int = 256,
+        min_value : float = 1e-8, spatial_shape : tuple = None
+    ):
+    """Function to initialise the quantile sketches for every grid
+    cell with the chosen backend. "tdigest" gives the flat array of
+    crick t-digests from init_tdigests, "uddsketch" gives a single
+    UDDSketchGrid which is updated for the whole grid at once.
+
+    Arguments
+    ----------
+    data_chunk : incoming xr.DataArray data chunk
+    backend : "tdigest" or "uddsketch", default "tdigest"
+    compression : compression value for the t-digests, default 60
+    alpha : initial relative accuracy of the UDDSketch, default 0.01
+    max_buckets : buckets per grid cell of the UDDSketch, default 256
+    min_value : smallest magnitude bucketed by the UDDSketch, smaller
+            values count as zero, default 1e-8
+    spatial_shape : shape of the spatial grid, if given data_chunk
+            is not inspected (and can be None)
+
+    Returns
+    ---------
+    sketches : the t-digest array or UDDSketchGrid
+    size_data_chunk_tail : size of global grid without time dimension
+    """
+    if backend == "tdigest":
+        return init_tdigests(data_chunk, compression, spatial_shape)
+
+    if backend == "uddsketch":
+        if spatial_shape is None:
+            spatial_shape = _spatial_shape(data_chunk)
+        size_data_chunk_tail = int(np.prod(spatial_shape))
+
+        sketches = UDDSketchGrid(
+            size_data_chunk_tail, alpha, max_buckets, min_value
+        )
+
+        return sketches, size_data_chunk_tail
+
+    raise ValueError(
+        f"backend must be 'tdigest' or 'uddsketch', not {backend}"
+    )
+
+def update_sketches(
+        data_chunk : xr.DataArray, size_data_chunk_tail : int,
+        sketches, n : int, w : int = 1, time_axis : int = None
+    ):
+    """Updates the sketches from init_sketches with the data chunk,
+    with the same arguments and returns as update_tdigests
+
+    Arguments
+    ---------
+    data_chunk : incoming xr.DataArray data chunk
+    size_data_chunk_tail : size of global grid without time dimension
+    sketches : t-digest array or UDDSketchGrid from init_sketches
+    n : current number of samples that have contributed to the statistic
+    w : length of time dimension of incoming data chunk
+    time_axis : index of the time dimension, looked up by name if not
+            given
+
+    Returns
+    ---------
+    n : updated with w
+    sketches : updated with the new data
+    """
+    if isinstance(sketches, UDDSketchGrid):
+        sketches.update(_time_first(data_chunk, time_axis))
+        return n + w, sketches
+
+    return update_tdigests(
+        data_chunk, size_data_chunk_tail, sketches, n, w, time_axis
+    )
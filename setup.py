@@ -16,6 +16,7 @@ setup(
 
     install_requires=[
         "numpy",
+        "numba",
         "xarray",
         "pandas",
         "cython",